@@ -12,7 +12,7 @@ import requests
 import string
 import re
 import random
-from clickclick import Action, info
+from clickclick import Action, info, warning
 from subprocess import check_call, call
 import tempfile
 import os
@@ -165,7 +165,12 @@ class IpAddressPoolDepletedException(Exception):
         super(IpAddressPoolDepletedException, self).__init__(msg)
 
 
-def generate_private_ip_addresses(ec2: object, subnets: list, cluster_size: int):
+def generate_private_ip_addresses(ec2: object, node_subnets: list):
+    '''
+    Generate one unused private IP address for every node, taken from
+    the subnet the node is placed in: node_subnets[i] is the subnet
+    of the i-th node.
+    '''
 
     def try_next_address(ips, subnet):
         try:
@@ -173,48 +178,48 @@ def generate_private_ip_addresses(ec2: object, subnets: list, cluster_size: int)
         except StopIteration:
             raise IpAddressPoolDepletedException(subnet['CidrBlock'])
 
-    #
-    # Here we have to account for the behavior of launch_*_nodes
-    # which iterate through subnets to put the instances into
-    # different Availability Zones.
-    #
-    network_ips = [netaddr.IPNetwork(s['CidrBlock']).iter_hosts() for s in subnets]
-
-    for idx, ips in enumerate(network_ips):
-        #
-        # Some of the first addresses in each subnet are
-        # taken by AWS system instances that we can't see,
-        # so we try to skip them.
-        #
-        for _ in range(10):
-            try_next_address(ips, subnets[idx])
-
-    i = 0
-    while i < cluster_size:
-        idx = i % len(subnets)
-
-        ip = try_next_address(network_ips[idx], subnets[idx])
+    network_ips = {}
+    for subnet in node_subnets:
+        cidr_block = subnet['CidrBlock']
+        if cidr_block not in network_ips:
+            ips = netaddr.IPNetwork(cidr_block).iter_hosts()
+            #
+            # Some of the first addresses in each subnet are
+            # taken by AWS system instances that we can't see,
+            # so we try to skip them.
+            #
+            for _ in range(10):
+                try_next_address(ips, subnet)
+            network_ips[cidr_block] = ips
 
-        resp = ec2.describe_instances(Filters=[{
-            'Name': 'private-ip-address',
-            'Values': [ip]
-        }])
-        if not resp['Reservations']:
-            i += 1
-            yield ip
+    for subnet in node_subnets:
+        while True:
+            ip = try_next_address(network_ips[subnet['CidrBlock']], subnet)
+
+            resp = ec2.describe_instances(Filters=[{
+                'Name': 'private-ip-address',
+                'Values': [ip]
+            }])
+            if not resp['Reservations']:
+                yield ip
+                break
 
 
-def allocate_ip_addresses(region_subnets: dict, cluster_size: int, node_ips: dict,
-                          take_elastic_ips: bool):
+def allocate_ip_addresses(placement: dict, node_ips: dict, take_elastic_ips: bool):
     '''
     Allocate unused private IP addresses by checking the current
     reservations, and optionally allocate Elastic IPs.
+
+    The addresses are generated in the order of the placement plan
+    nodes, so that node_ips[region][i] belongs to the subnet of
+    placement[region]['Nodes'][i].
     '''
-    for region, subnets in region_subnets.items():
+    for region, plan in placement.items():
         with Action('Allocating IP addresses in {}..'.format(region)) as act:
             ec2 = boto3.client('ec2', region_name=region)
 
-            for ip in generate_private_ip_addresses(ec2, subnets, cluster_size):
+            node_subnets = [node['Subnet'] for node in plan['Nodes']]
+            for ip in generate_private_ip_addresses(ec2, node_subnets):
                 address = {'PrivateIp': ip}
 
                 if take_elastic_ips:
@@ -229,13 +234,15 @@ def allocate_ip_addresses(region_subnets: dict, cluster_size: int, node_ips: dic
                 act.progress()
 
 
-def pick_seed_node_ips(node_ips: dict, seed_count: int) -> dict:
+def pick_seed_node_ips(node_ips: dict, placement: dict) -> dict:
     '''
-    Take first {seed_count} IPs in every region for the seed nodes.
+    Take the IPs of the nodes marked as seeds in the placement plan
+    in every region.
     '''
     seed_nodes = {}
     for region, ips in node_ips.items():
-        seed_nodes[region] = ips[0:seed_count]
+        nodes = placement[region]['Nodes']
+        seed_nodes[region] = [ip for ip, node in zip(ips, nodes) if node['Seed']]
 
         list_ips = [ip['_defaultIp'] for ip in seed_nodes[region]]
         info('Our seed nodes in {} will be: {}'.format(region, ', '.join(list_ips)))
@@ -261,6 +268,121 @@ def get_subnets(prefix_filter: str, regions: list) -> dict:
     return subnets
 
 
+class PlacementException(Exception):
+    pass
+
+
+def find_instance_type_azs(regions: list, instance_type: str) -> dict:
+    '''
+    Returns a dict of per-region sets of Availability Zones, in which
+    the specified instance type is offered.
+    '''
+    result = {}
+    for region in regions:
+        with Action('Checking {} availability in {}..'.format(instance_type, region)):
+            ec2 = boto3.client('ec2', region)
+            resp = ec2.describe_instance_type_offerings(
+                LocationType='availability-zone',
+                Filters=[{'Name': 'instance-type', 'Values': [instance_type]}])
+            result[region] = {o['Location'] for o in resp['InstanceTypeOfferings']}
+    return result
+
+
+def choose_rack_count(az_count: int, cluster_size: int, replication_factor: int) -> int:
+    '''
+    Choose the number of racks out of {az_count} usable AZs.
+
+    Prefer the largest rack count that divides the cluster size, so
+    that every rack gets the same number of nodes, and that is not
+    less than the replication factor, so that every replica can go to
+    a different rack.  If there is no such count, fall back to a
+    multiple of the replication factor, where possible.
+    '''
+    for rack_count in range(min(az_count, cluster_size), 0, -1):
+        if cluster_size % rack_count == 0 and rack_count >= replication_factor:
+            return rack_count
+
+    rack_count = az_count
+    if rack_count > replication_factor:
+        rack_count -= rack_count % replication_factor
+    return min(rack_count, cluster_size)
+
+
+def plan_placement(regions: list, region_subnets: dict, available_azs: dict, cluster_size: int,
+                   replication_factor: int) -> dict:
+    '''
+    Build the placement plan for every region: with Ec2Snitch every
+    Availability Zone is a rack, so we pick one subnet per usable AZ
+    and spread the nodes across these racks round-robin.  The number
+    of racks is picked by choose_rack_count().
+
+    Every rack gets exactly one seed node: the first node placed in it.
+
+    Raises PlacementException if the plan cannot be fulfilled, before
+    anything is allocated.
+    '''
+    placement = {}
+    for region in regions:
+        # one subnet per AZ, subnets come sorted by the AZ already
+        az_subnets = collections.OrderedDict()
+        for subnet in region_subnets.get(region, []):
+            az_subnets.setdefault(subnet['AvailabilityZone'], subnet)
+
+        if not az_subnets:
+            raise PlacementException('No subnets found in region {}'.format(region))
+
+        unavailable = [az for az in az_subnets if az not in available_azs[region]]
+        if unavailable:
+            warning('Instance type is not offered in {}, skipping'.format(', '.join(unavailable)))
+
+        racks = [s for az, s in az_subnets.items() if az in available_azs[region]]
+        if not racks:
+            raise PlacementException('Instance type is not offered in any Availability Zone '
+                                     'of region {}'.format(region))
+
+        rack_count = choose_rack_count(len(racks), cluster_size, replication_factor)
+
+        unused = [r['AvailabilityZone'] for r in racks[rack_count:]]
+        if unused:
+            info('Not using {} to keep {} racks in {} balanced for cluster size {} '
+                 'and replication factor {}'.format(', '.join(unused), rack_count, region,
+                                                    cluster_size, replication_factor))
+        racks = racks[:rack_count]
+
+        nodes = [{'Subnet': racks[i % rack_count], 'Seed': i < rack_count}
+                 for i in range(cluster_size)]
+
+        placement[region] = {'Racks': racks, 'Nodes': nodes}
+    return placement
+
+
+def validate_placement(placement: dict, replication_factor: int):
+    '''
+    Warn about the plans which would result in unbalanced racks or in
+    more than one replica per rack.
+    '''
+    for region, plan in placement.items():
+        rack_count = len(plan['Racks'])
+        cluster_size = len(plan['Nodes'])
+        if cluster_size % rack_count:
+            warning('Cluster size {} cannot be evenly spread across {} racks in {}, '
+                    'the load will be unbalanced'.format(cluster_size, rack_count, region))
+        if rack_count < min(replication_factor, cluster_size):
+            warning('Only {} racks available in {} for replication factor {}, '
+                    'some racks will hold more than one replica'.format(rack_count, region,
+                                                                        replication_factor))
+
+
+def print_placement(placement: dict):
+    for region, plan in placement.items():
+        info('Placement plan for {}:'.format(region))
+        for rack in plan['Racks']:
+            nodes = [n for n in plan['Nodes'] if n['Subnet'] is rack]
+            seeds = [n for n in nodes if n['Seed']]
+            info('  {} ({}): {} nodes, {} seeds'.format(rack['AvailabilityZone'], rack['SubnetId'],
+                                                       len(nodes), len(seeds)))
+
+
 def hostname_from_private_ip(region: str, ip: str) -> str:
     return 'ip-{}.{}.compute.internal.'.format('-'.join(ip.split('.')), region)
 
@@ -455,14 +577,16 @@ def launch_instance(region: str, ip: dict, ami: object, subnet_id: str,
 
 
 def launch_seed_nodes(options: dict):
-    total_seed_count = options['seed_count'] * len(options['regions'])
+    total_seed_count = sum(node['Seed'] for plan in options['placement'].values() for node in plan['Nodes'])
     seeds_launched = 0
-    for region, ips in options['seed_nodes'].items():
-        subnets = options['subnets'][region]
-        for i, ip in enumerate(ips):
+    for region, ips in options['node_ips'].items():
+        nodes = options['placement'][region]['Nodes']
+        for ip, node in zip(ips, nodes):
+            if not node['Seed']:
+                continue
             launch_instance(region, ip,
                             ami=options['taupage_amis'][region],
-                            subnet_id=subnets[i % len(subnets)]['SubnetId'],
+                            subnet_id=node['Subnet']['SubnetId'],
                             security_group_id=options['security_groups'][region]['GroupId'],
                             is_seed=True,
                             options=options)
@@ -475,15 +599,15 @@ def launch_seed_nodes(options: dict):
 def launch_normal_nodes(options: dict):
     # TODO: parallelize by region?
     for region, ips in options['node_ips'].items():
-        subnets = options['subnets'][region]
-        for i, ip in enumerate(ips):
-            if i >= options['seed_count']:
+        nodes = options['placement'][region]['Nodes']
+        for ip, node in zip(ips, nodes):
+            if not node['Seed']:
                 # avoid stating all nodes at the same time
                 info("Sleeping for one minute before launching next node..")
                 time.sleep(60)
                 launch_instance(region, ip,
                                 ami=options['taupage_amis'][region],
-                                subnet_id=subnets[i % len(subnets)]['SubnetId'],
+                                subnet_id=node['Subnet']['SubnetId'],
                                 security_group_id=options['security_groups'][region]['GroupId'],
                                 is_seed=False,
                                 options=options)
@@ -531,6 +655,8 @@ either correct the error or retry.
 @click.option('--cluster-name', help='name of the cluster, required')
 @click.option('--cluster-size', default=3, type=int, help='number of nodes per region, default: 3')
 @click.option('--instance-type', default='t2.micro', help='default: t2.micro')
+@click.option('--replication-factor', default=3, type=int,
+              help='expected replication factor per region, used to balance nodes across racks, default: 3')
 @click.option('--volume-type', default='gp2', help='gp2 (default) | io1 | standard')
 @click.option('--volume-size', default=8, type=int, help='in GB, default: 8')
 @click.option('--volume-iops', default=100, type=int, help='for type io1, default: 100')
@@ -541,7 +667,7 @@ either correct the error or retry.
 @click.option('--docker-image', help='Docker image to use (default: use latest planb-cassandra)')
 @click.argument('regions', nargs=-1)
 def cli(cluster_name: str, regions: list, cluster_size: int, instance_type: str,
-        volume_type: str, volume_size: int, volume_iops: int,
+        replication_factor: int, volume_type: str, volume_size: int, volume_iops: int,
         no_termination_protection: bool, internal: bool, hosted_zone: str, scalyr_key: str, docker_image: str):
 
     if not cluster_name:
@@ -560,6 +686,12 @@ def cli(cluster_name: str, regions: list, cluster_size: int, instance_type: str,
     if internal:
         region = regions[0]
 
+    if cluster_size < 1:
+        raise click.UsageError('Cluster size must be at least 1')
+
+    if replication_factor < 1:
+        raise click.UsageError('Replication factor must be at least 1')
+
     keystore, truststore = generate_certificate(cluster_name)
 
     # List of IP addresses by region
@@ -569,21 +701,25 @@ def cli(cluster_name: str, regions: list, cluster_size: int, instance_type: str,
     security_groups = {}
 
     try:
-        taupage_amis = find_taupage_amis(regions)
-
         subnets = get_subnets('internal-' if internal else 'dmz-', regions)
 
-        allocate_ip_addresses(subnets, cluster_size, node_ips,
-                              take_elastic_ips=not(internal))
+        # Build and validate the full placement plan before allocating anything
+        available_azs = find_instance_type_azs(regions, instance_type)
+        placement = plan_placement(regions, subnets, available_azs, cluster_size,
+                                   replication_factor)
+        print_placement(placement)
+        validate_placement(placement, replication_factor)
+
+        taupage_amis = find_taupage_amis(regions)
+
+        allocate_ip_addresses(placement, node_ips, take_elastic_ips=not(internal))
 
         if hosted_zone:
             setup_dns_records(cluster_name, hosted_zone, node_ips)
 
         setup_security_groups(internal, cluster_name, node_ips, security_groups)
 
-        # We should have up to 3 seeds nodes per DC
-        seed_count = min(cluster_size, 3)
-        seed_nodes = pick_seed_node_ips(node_ips, seed_count)
+        seed_nodes = pick_seed_node_ips(node_ips, placement)
 
         user_data = generate_taupage_user_data(locals())
         taupage_user_data = '#taupage-ami-config\n{}'.format(yaml.safe_dump(user_data))
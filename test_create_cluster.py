@@ -1,6 +1,7 @@
 import pytest
 from unittest.mock import MagicMock
 
+import create_cluster
 from create_cluster import *
 
 def test_generate_private_ip_addresses():
@@ -36,12 +37,169 @@ def test_generate_private_ip_addresses():
     cluster_size = 5
 
     for region, subnets in region_subnets.items():
-        assert list(generate_private_ip_addresses(ec2, subnets, cluster_size)) == expected_ips[region]
+        node_subnets = [subnets[i % len(subnets)] for i in range(cluster_size)]
+        assert list(generate_private_ip_addresses(ec2, node_subnets)) == expected_ips[region]
 
     with pytest.raises(IpAddressPoolDepletedException):
-        print(list(generate_private_ip_addresses(ec2, [{'CidrBlock': '192.168.1.0/29'}], 10)))
+        print(list(generate_private_ip_addresses(ec2, [{'CidrBlock': '192.168.1.0/29'}] * 10)))
 
-    list(generate_private_ip_addresses(ec2, [{'CidrBlock': '192.168.1.0/27'}], 20))
+    list(generate_private_ip_addresses(ec2, [{'CidrBlock': '192.168.1.0/27'}] * 20))
 
     with pytest.raises(IpAddressPoolDepletedException):
-        list(generate_private_ip_addresses(ec2, [{'CidrBlock': '192.168.1.0/27'}], 21))
+        list(generate_private_ip_addresses(ec2, [{'CidrBlock': '192.168.1.0/27'}] * 21))
+
+
+def test_allocate_ip_addresses(monkeypatch):
+    ec2 = MagicMock()
+    ec2.describe_instances.return_value = {'Reservations': []}
+    monkeypatch.setattr(create_cluster.boto3, 'client', lambda *args, **kwargs: ec2)
+
+    subnet_a = {'SubnetId': 'subnet-a', 'CidrBlock': '172.31.0.0/24'}
+    subnet_b = {'SubnetId': 'subnet-b', 'CidrBlock': '172.31.1.0/24'}
+    # deliberately not round-robin
+    nodes = [{'Subnet': s, 'Seed': False} for s in (subnet_a, subnet_a, subnet_b, subnet_a)]
+    placement = {'eu-west-1': {'Racks': [subnet_a, subnet_b], 'Nodes': nodes}}
+    node_ips = collections.defaultdict(list)
+
+    allocate_ip_addresses(placement, node_ips, take_elastic_ips=False)
+
+    ips = node_ips['eu-west-1']
+    assert len(ips) == len(nodes)
+    for ip, node in zip(ips, nodes):
+        assert netaddr.IPAddress(ip['PrivateIp']) in netaddr.IPNetwork(node['Subnet']['CidrBlock'])
+    assert len({ip['PrivateIp'] for ip in ips}) == len(ips)
+
+
+def make_subnets(az_count: int) -> dict:
+    azs = 'abcde'[:az_count]
+    return {'eu-west-1': [{'SubnetId': 'subnet-{}'.format(az), 'AvailabilityZone': 'eu-west-1{}'.format(az)}
+                          for az in azs]}
+
+
+def make_available_azs(azs: str) -> dict:
+    return {'eu-west-1': {'eu-west-1{}'.format(az) for az in azs}}
+
+
+def rack_sizes(plan: dict) -> list:
+    return [len([n for n in plan['Nodes'] if n['Subnet'] is rack]) for rack in plan['Racks']]
+
+
+def rack_seeds(plan: dict) -> list:
+    return [len([n for n in plan['Nodes'] if n['Subnet'] is rack and n['Seed']]) for rack in plan['Racks']]
+
+
+@pytest.mark.parametrize('az_count, cluster_size, replication_factor, expected_rack_sizes', [
+    # all racks used when they divide the cluster size evenly
+    (4, 4, 3, [1, 1, 1, 1]),
+    (4, 8, 3, [2, 2, 2, 2]),
+    (3, 6, 3, [2, 2, 2]),
+    # drop AZs to get a balanced plan
+    (4, 6, 3, [2, 2, 2]),
+    (5, 6, 2, [2, 2, 2]),
+    # no balanced plan with enough racks: fall back to a multiple of RF
+    (3, 4, 3, [2, 1, 1]),
+    (4, 5, 3, [2, 2, 1]),
+    # fewer AZs than RF
+    (2, 4, 3, [2, 2]),
+    (1, 3, 3, [3]),
+    # fewer nodes than AZs
+    (3, 2, 3, [1, 1]),
+])
+def test_plan_placement_rack_count(az_count, cluster_size, replication_factor, expected_rack_sizes):
+    placement = plan_placement(['eu-west-1'], make_subnets(az_count), make_available_azs('abcde'),
+                               cluster_size=cluster_size, replication_factor=replication_factor)
+    plan = placement['eu-west-1']
+
+    assert rack_sizes(plan) == expected_rack_sizes
+    # one seed per rack
+    assert rack_seeds(plan) == [1] * len(expected_rack_sizes)
+
+
+def test_plan_placement_skips_unavailable_azs():
+    placement = plan_placement(['eu-west-1'], make_subnets(4), make_available_azs('bcd'),
+                               cluster_size=3, replication_factor=3)
+    plan = placement['eu-west-1']
+
+    assert [r['SubnetId'] for r in plan['Racks']] == ['subnet-b', 'subnet-c', 'subnet-d']
+
+
+def test_plan_placement_no_available_azs():
+    with pytest.raises(PlacementException):
+        plan_placement(['eu-west-1'], make_subnets(3), make_available_azs(''),
+                       cluster_size=3, replication_factor=3)
+
+
+def test_plan_placement_region_without_subnets():
+    # region without any matching subnets is missing from get_subnets() result
+    available_azs = dict(make_available_azs('a'), **{'eu-central-1': {'eu-central-1a'}})
+    with pytest.raises(PlacementException):
+        plan_placement(['eu-west-1', 'eu-central-1'], make_subnets(1), available_azs,
+                       cluster_size=3, replication_factor=3)
+
+
+def test_validate_placement(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(create_cluster, 'warning', warnings.append)
+
+    racks = [{'SubnetId': 'subnet-a'}, {'SubnetId': 'subnet-b'}, {'SubnetId': 'subnet-c'}]
+
+    def placement(rack_count, cluster_size):
+        return {'eu-west-1': {
+            'Racks': racks[:rack_count],
+            'Nodes': [{'Subnet': racks[i % rack_count], 'Seed': False} for i in range(cluster_size)]
+        }}
+
+    validate_placement(placement(3, 6), 3)
+    assert warnings == []
+
+    validate_placement(placement(3, 4), 3)
+    assert len(warnings) == 1 and 'unbalanced' in warnings[0]
+
+    warnings.clear()
+    validate_placement(placement(2, 4), 3)
+    assert len(warnings) == 1 and 'more than one replica' in warnings[0]
+
+
+def test_launch_nodes_use_planned_subnets(monkeypatch):
+    launched = []
+
+    def launch_instance(region, ip, ami, subnet_id, security_group_id, is_seed, options):
+        launched.append((ip['_defaultIp'], subnet_id, is_seed))
+
+    monkeypatch.setattr(create_cluster, 'launch_instance', launch_instance)
+    monkeypatch.setattr(create_cluster.time, 'sleep', lambda s: None)
+
+    racks = [{'SubnetId': 'subnet-a'}, {'SubnetId': 'subnet-b'}]
+    nodes = [{'Subnet': racks[i % 2], 'Seed': i < 2} for i in range(5)]
+    options = {
+        'regions': ['eu-west-1'],
+        'node_ips': {'eu-west-1': [{'_defaultIp': '10.0.0.{}'.format(i)} for i in range(5)]},
+        'placement': {'eu-west-1': {'Racks': racks, 'Nodes': nodes}},
+        'taupage_amis': {'eu-west-1': None},
+        'security_groups': {'eu-west-1': {'GroupId': 'sg-1'}}
+    }
+
+    launch_seed_nodes(options)
+    launch_normal_nodes(options)
+
+    assert launched == [
+        ('10.0.0.0', 'subnet-a', True),
+        ('10.0.0.1', 'subnet-b', True),
+        ('10.0.0.2', 'subnet-a', False),
+        ('10.0.0.3', 'subnet-b', False),
+        ('10.0.0.4', 'subnet-a', False)
+    ]
+
+
+def test_pick_seed_node_ips():
+    placement = {
+        'eu-west-1': {
+            'Racks': [],
+            'Nodes': [{'Seed': True}, {'Seed': False}, {'Seed': True}]
+        }
+    }
+    node_ips = {'eu-west-1': [{'_defaultIp': '10.0.0.{}'.format(i)} for i in range(3)]}
+
+    assert pick_seed_node_ips(node_ips, placement) == {
+        'eu-west-1': [{'_defaultIp': '10.0.0.0'}, {'_defaultIp': '10.0.0.2'}]
+    }